@@ -1,5 +1,6 @@
 import os
 import string
+import fnmatch
 import data
 import itertools
 from collections import namedtuple, deque
@@ -10,25 +11,66 @@ from data import RefValue
 # Retrieve list of ignored files
 ignore_list = data.get_ignore_list()
 
+# Re-reads the list of ignored files from the current directory, e.g. after changing into another repository.
+def reload_ignore_list():
+    global ignore_list
+    ignore_list = data.get_ignore_list()
+
 # Writes a tree object to the object directory. Returns the SHA1 checksum of the newly created tree object.
-def write_tree(directory='.'):
+# Under a sparse checkout, paths outside the sparse patterns are not on disk, so their entries are carried over
+# unchanged from base_tree (the tree of HEAD) instead of being dropped.
+def write_tree(directory='.', base_tree=None, filters=()):
     tree = []
-    with os.scandir(directory) as it:
-        for entry in it:
-            path = f'{directory}/{entry.name}'
-            if is_ignored(path):
+    names = set()
+    if os.path.isdir(directory):
+        with os.scandir(directory) as it:
+            for entry in it:
+                path = f'{directory}/{entry.name}'
+                if is_ignored(path):
+                    continue
+
+                if entry.is_file(follow_symlinks=False):
+                    if not _is_selected(path, filters):
+                        continue
+                    tree.append(_add_file_to_tree(path, entry.name))
+                elif entry.is_dir(follow_symlinks=False):
+                    if not _may_select(path, filters):
+                        continue
+                    subtree = _find_in_tree(base_tree, entry.name) if filters else None
+                    tree.append(_add_tree_to_tree(write_tree(path, subtree, filters), entry.name))
+                else:
+                    continue
+                names.add(entry.name)
+
+    if filters:
+        for type_, oid, filename in _iterate_tree(base_tree):
+            if filename in names:
                 continue
-
-            if entry.is_file(follow_symlinks=False):
-                tree.append(_add_file_to_tree(path, entry.name))
-            elif entry.is_dir(follow_symlinks=False):
-                tree.append(_add_tree_to_tree(write_tree(path), entry.name))
+            path = f'{directory}/{filename}'
+            if type_ == 'blob' and not _is_selected(path, filters):
+                tree.append(f'{data.OBJ_TYPES["blob"]} blob {oid} {filename}\n')
+            elif type_ == 'tree' and _may_select(path, filters):
+                # Partially selected directory that is missing on disk: keep only its unselected entries.
+                subtree = write_tree(path, oid, filters)
+                if data.get_object_content(subtree):
+                    tree.append(_add_tree_to_tree(subtree, filename))
+            elif type_ == 'tree':
+                tree.append(_add_tree_to_tree(oid, filename))
 
     tree_data = ''.join(tree)
     return data.hash_object('tree', tree_data.encode(), write=True)
 
+# Returns the object ID of the subtree with the given name in the given tree, or None.
+def _find_in_tree(tree_id, name):
+    for type_, oid, filename in _iterate_tree(tree_id):
+        if filename == name and type_ == 'tree':
+            return oid
+    return None
+
 # Returns True if the given file is on the ignored list, False otherwise.
 def is_ignored(path):
+    if data.GIT_DIR in path.split('/'):
+        return True
     for ignored in ignore_list:
         if ignored in path.split('/'):
             return True
@@ -53,27 +95,87 @@ def _iterate_tree(tree_id):
         _, type_, oid, filename = line.split(' ', 3)
         yield type_, oid, filename
 
-# Returns a dictionary object containing paths of all files in the given base_path value.
-# By default, uses the current working directory.
-def get_tree(tree_id, base_path=''):
-    tree = {}
+# Pathspecs restrict tree operations to a subset of paths. Each pathspec is matched against a path component by
+# component with fnmatch and selects the path if it matches the path itself or one of its leading directories, so
+# 'src' selects everything under src/ and 'docs/*.md' selects the markdown files directly in docs/.
+# An empty list of pathspecs selects everything.
+def _split_path(path):
+    return [part for part in path.split('/') if part not in ('', '.')]
+
+# Returns True if the given path is selected by the given pathspecs.
+def is_in_pathspec(path, pathspecs):
+    if not pathspecs:
+        return True
+    parts = _split_path(path)
+    for pathspec in pathspecs:
+        spec_parts = _split_path(pathspec)
+        if len(spec_parts) <= len(parts) and all(map(fnmatch.fnmatchcase, parts, spec_parts)):
+            return True
+    return False
+
+# Returns True if the given directory may contain paths selected by the given pathspecs, i.e. if it is worth
+# descending into.
+def _may_contain_pathspec(directory, pathspecs):
+    if not pathspecs:
+        return True
+    parts = _split_path(directory)
+    for pathspec in pathspecs:
+        if all(map(fnmatch.fnmatchcase, parts, _split_path(pathspec))):
+            return True
+    return False
+
+# Returns the list of pathspec lists a path has to satisfy: the given pathspecs and, if sparse is set, the
+# sparse-checkout patterns.
+def _path_filters(pathspecs=None, sparse=False):
+    filters = [pathspecs, data.get_sparse_patterns() if sparse else None]
+    return [pathspec_list for pathspec_list in filters if pathspec_list]
+
+def _is_selected(path, filters):
+    return all(is_in_pathspec(path, pathspecs) for pathspecs in filters)
+
+def _may_select(directory, filters):
+    return all(_may_contain_pathspec(directory, pathspecs) for pathspecs in filters)
+
+# Lazily iterates over the files in the given tree, yielding the path and object ID of each file selected by
+# filters. Only descends into subtrees that may contain selected files.
+def iter_tree(tree_id, base_path='', filters=()):
     for type_, oid, filename in _iterate_tree(tree_id):
         assert '/' not in filename
         assert filename not in ('.', '..')
         path = f'{base_path}{filename}'
         if type_ == 'blob':
-            tree[path] = oid
+            if _is_selected(path, filters):
+                yield path, oid
         elif type_ == 'tree':
-            tree.update(get_tree(oid, f'{path}/'))
+            if _may_select(path, filters):
+                yield from iter_tree(oid, f'{path}/', filters)
         else:
             assert False, f'Unknown object type: {type_}'
-    return tree
+
+# Returns the object type and object ID of the file or directory at the given path in the given tree, or
+# (None, None) if it does not exist. Only reads the trees along the path.
+def get_path_entry(tree_id, path):
+    type_, oid = 'tree', tree_id
+    for name in _split_path(path):
+        if type_ != 'tree':
+            return None, None
+        type_, oid = next(((entry_type, entry_oid) for entry_type, entry_oid, filename in _iterate_tree(oid)
+                           if filename == name), (None, None))
+        if oid is None:
+            return None, None
+    return type_, oid
+
+# Returns a dictionary object containing paths of all files in the given base_path value.
+# By default, uses the current working directory. Restricted to the given pathspecs and, if sparse is set, to the
+# sparse-checkout patterns.
+def get_tree(tree_id, base_path='', pathspecs=None, sparse=False):
+    return dict(iter_tree(tree_id, base_path, _path_filters(pathspecs, sparse)))
 
 # Low level plumbing command. Reads a tree into the working directory.
-# Effectively like rolling back to a previous commit.
+# Effectively like rolling back to a previous commit. Only materialises the paths in the sparse checkout.
 def read_tree(tree_id):
     _empty_current_directory()
-    for path, oid in get_tree(tree_id).items():
+    for path, oid in get_tree(tree_id, sparse=True).items():
         parent_directory = os.path.dirname(path)
         if parent_directory != '':
             os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -121,33 +223,58 @@ def get_commit(oid):
 # Commit the working directory. Currently, commits its entirety. Writes the tree, creates commit object and updates HEAD
 # TODO: Commit only the contents of the index file.
 def commit(message):
-    oid = write_tree()
-    content = f"tree {oid}\n"
-
+    # The snapshot takes no lock, so concurrent commits write their objects in parallel.
     # Check if HEAD points to an empty reference. This will generally only happen if no commit has been made since
     # initialization.
     HEAD = data.get_ref('HEAD')
+    head_tree = get_commit(HEAD.value).tree if HEAD.value else None
     MERGE_HEAD = data.get_ref('MERGE_HEAD')
-    if HEAD.value is not None:
-        content += f"commit {HEAD.value}\n"
-    if MERGE_HEAD.value is not None:
-        content += f"commit {MERGE_HEAD.value}\n"
-        data.delete_ref('MERGE_HEAD', deref=False)
-    content += f'\n{message}\n'
-    commit_oid = data.hash_object('commit', content.encode(), write=True)
-    data.update_ref('HEAD', RefValue(symbolic=False, value=commit_oid))
+    # read_tree_merged writes the whole merged tree to disk, including paths outside the sparse checkout, so a
+    # merge commit snapshots everything instead of carrying those paths over from HEAD.
+    filters = _path_filters(sparse=True) if MERGE_HEAD.value is None else []
+    oid = write_tree(base_tree=head_tree, filters=filters)
+
+    # Only the MERGE_HEAD handling and the HEAD update hold the repository lock. checkout and merge hold it while
+    # rewriting the working directory and move HEAD or MERGE_HEAD before releasing it, so if one of them ran during
+    # the snapshot the checks below notice and we refuse rather than record a half-written tree.
+    with data.repository_lock():
+        assert data.get_ref('MERGE_HEAD').value == MERGE_HEAD.value, \
+            'A merge started or finished while committing, please retry'
+
+        # Compare-and-swap HEAD. If another process committed in the meantime and its tree is the one our snapshot
+        # started from or the one we are committing, rebuild the commit on its new HEAD rather than dropping their
+        # commit. Any other tree (e.g. after a reset or checkout) would be silently undone, so give up instead.
+        for attempt in range(data.LOCK_RETRIES):
+            content = f"tree {oid}\n"
+            if HEAD.value is not None:
+                content += f"commit {HEAD.value}\n"
+            if MERGE_HEAD.value is not None:
+                content += f"commit {MERGE_HEAD.value}\n"
+            content += f'\n{message}\n'
+            commit_oid = data.hash_object('commit', content.encode(), write=True)
+            if data.update_ref('HEAD', RefValue(symbolic=False, value=commit_oid), expected=HEAD.value):
+                break
+            data.backoff(attempt)
+            HEAD = data.get_ref('HEAD')
+            assert HEAD.value and get_commit(HEAD.value).tree in (head_tree, oid), \
+                'HEAD moved to a different tree while committing, please retry'
+        else:
+            raise TimeoutError('HEAD kept changing while committing, giving up')
+
+        if MERGE_HEAD.value is not None:
+            data.delete_ref('MERGE_HEAD', deref=False, expected=MERGE_HEAD.value)
     return f"Created new commit: {commit_oid}"
 
 def checkout(refname):
     commit = get_commit(refname)
-    read_tree(commit.tree)
-    data.update_ref('HEAD', data.RefValue(symbolic=True, value=f'ref: refs/heads/{refname}'), deref=False)
+    with data.repository_lock():
+        read_tree(commit.tree)
 
-    if is_branch(refname):
-        HEAD = data.RefValue(symbolic=True, value=f'refs/heads/{refname}')
-    else:
-        HEAD = data.RefValue(symbolic=False, value=refname)
-    data.update_ref('HEAD', HEAD, deref=False)
+        if is_branch(refname):
+            HEAD = data.RefValue(symbolic=True, value=f'refs/heads/{refname}')
+        else:
+            HEAD = data.RefValue(symbolic=False, value=refname)
+        data.update_ref('HEAD', HEAD, deref=False)
 
 def is_branch(name):
     return data.get_ref(f'refs/heads/{name}').value is not None
@@ -168,6 +295,13 @@ def tag(tagname, commit_id):
     data.update_ref(f'refs/tags/{tagname}', data.RefValue(symbolic=False, value = commit_id), deref=True)
 
 def get_oid(tagname):
+    if tagname == 'HEAD': return data.get_ref('HEAD').value
+    oid = find_oid(tagname)
+    assert oid, f'No such reference or object: {tagname}'
+    return oid
+
+# Like get_oid, but returns None instead of failing if the given name is neither a reference nor an object ID.
+def find_oid(tagname):
     if tagname == 'HEAD': return data.get_ref('HEAD').value
     options = [
         f'{tagname}',
@@ -184,15 +318,17 @@ def get_oid(tagname):
     if len(tagname) == 40 and is_sha1:
         return tagname
 
-    assert False, f'No such reference or object: {tagname}'
+    return None
 
-def iter_commits_and_parents(oids):
+# Iterates over the given commits and all of their ancestors. Commits in exclude are neither yielded nor walked
+# past, which bounds the walk to the commits that are not already known.
+def iter_commits_and_parents(oids, exclude=()):
     oids = deque({get_oid(oid) for oid in oids})
     visited = set()
 
     while oids:
         oid = oids.popleft()
-        if not oid or oid in visited:
+        if not oid or oid in visited or oid in exclude:
             continue
         else:
             visited.add(oid)
@@ -201,12 +337,18 @@ def iter_commits_and_parents(oids):
         oids.extendleft(commit.parents[:1])
         oids.extend(commit.parents[1:])
 
-def get_working_directory():
+# Returns a dictionary of the files in the working directory, restricted to the given pathspecs and the sparse
+# checkout. Directories that cannot contain selected files are not walked.
+def get_working_directory(pathspecs=None):
+    filters = _path_filters(pathspecs, sparse=True)
     tree = {}
     for root, dirnames, filenames in os.walk('.'):
+        dirnames[:] = [dirname for dirname in dirnames
+                       if not is_ignored(os.path.relpath(f'{root}/{dirname}'))
+                       and _may_select(f'{root}/{dirname}', filters)]
         for filename in filenames:
             path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
+            if is_ignored(path) or not os.path.isfile(path) or not _is_selected(path, filters):
                 continue
             with open(path, 'rb') as f:
                 tree[path] = data.hash_object('blob', f.read(), write=True)
@@ -225,18 +367,21 @@ def read_tree_merged(HEAD, other, base):
 
 
 def merge(oid):
-    HEAD = data.get_ref('HEAD')
-    assert HEAD
-    base = merge_base(HEAD.value, oid)
-    if base == HEAD.value:
-        data.update_ref('HEAD', data.RefValue(symbolic=False, value=oid))
-        print("Fast-forward merge, no need to commit")
-        return
-    c_HEAD = get_commit('HEAD')
-    c_other = get_commit(oid)
-    c_base = get_commit(base)
-    data.update_ref('MERGE_HEAD', RefValue(symbolic=False, value=oid))
-    read_tree_merged(c_HEAD.tree, c_other.tree, c_base.tree)
+    with data.repository_lock():
+        HEAD = data.get_ref('HEAD')
+        assert HEAD
+        base = merge_base(HEAD.value, oid)
+        if base == HEAD.value:
+            updated = data.update_ref('HEAD', data.RefValue(symbolic=False, value=oid), expected=HEAD.value)
+            assert updated, 'HEAD changed during merge, please retry'
+            print("Fast-forward merge, no need to commit")
+            return
+        c_HEAD = get_commit(HEAD.value)
+        c_other = get_commit(oid)
+        c_base = get_commit(base)
+        updated = data.update_ref('MERGE_HEAD', RefValue(symbolic=False, value=oid), expected=None)
+        assert updated, 'A merge is already in progress, commit it first'
+        read_tree_merged(c_HEAD.tree, c_other.tree, c_base.tree)
     print("Merged in working directory\nPlease commit")
 
 def merge_base(commit_1, commit_2):
@@ -0,0 +1,129 @@
+import os
+import difflib
+from collections import namedtuple
+import data
+import base
+
+BlameLine = namedtuple('BlameLine', ['commit', 'line'])
+
+# Returns a BlameLine for every line of the file at path in the given commit, naming the commit that last changed
+# the line. History is only followed through commits where the path's blob changes: if a parent has the same blob,
+# all lines are passed to it untouched. Otherwise the blobs are diffed in-process and the lines that also appear in
+# a parent are passed on; the rest were introduced by the commit itself.
+def blame(path, commit_oid):
+    type_, blob = base.get_path_entry(base.get_commit(commit_oid).tree, path)
+    assert blob, f'No such file {path} in {commit_oid}'
+    assert type_ == 'blob', f'{path} is not a file in {commit_oid}'
+    lines = _get_blob_lines(blob)
+    commits = [None] * len(lines)
+
+    # commit -> (blob of path in commit, {line in blob: [lines of the blamed file it became]})
+    # Lines only move from a commit to its parents, and a commit's generation is greater than that of any of its
+    # ancestors. Taking the pending commit with the highest generation therefore processes each commit only after
+    # every child that can pass it lines, so each commit is diffed at most once. Generations are only computed
+    # once history branches, so a linear walk that ends in a cache hit does not read the whole history.
+    pending = {commit_oid: (blob, {index: [index] for index in range(len(lines))})}
+    generations = {}
+    introduced = None
+    cache_hit = False
+    while pending:
+        if len(pending) == 1:
+            oid = next(iter(pending))
+        else:
+            oid = max(pending, key=lambda pending_oid: _get_generation(pending_oid, generations))
+        blob, line_map = pending.pop(oid)
+        parent_blobs = [(parent, _get_blob_oid(parent, path)) for parent in base.get_commit(oid).parents]
+        unchanged_parent = next((parent for parent, parent_blob in parent_blobs if parent_blob == blob), None)
+        if unchanged_parent:
+            _add_pending(pending, unchanged_parent, blob, line_map)
+            continue
+
+        # The first commit that changes the blob is where the blamed version of the file was introduced.
+        introduced = introduced or (oid, blob)
+        cached = _read_cache(blob, oid)
+        if cached:
+            cache_hit = cache_hit or introduced == (oid, blob)
+            for line, targets in line_map.items():
+                for target in targets:
+                    commits[target] = cached[line]
+            continue
+
+        blob_lines = _get_blob_lines(blob)
+        for parent, parent_blob in parent_blobs:
+            if not parent_blob or not line_map:
+                continue
+            matcher = difflib.SequenceMatcher(None, _get_blob_lines(parent_blob), blob_lines, autojunk=False)
+            passed = {}
+            for parent_start, start, size in matcher.get_matching_blocks():
+                for offset in range(size):
+                    if start + offset in line_map:
+                        passed[parent_start + offset] = line_map.pop(start + offset)
+            if passed:
+                _add_pending(pending, parent, parent_blob, passed)
+
+        for targets in line_map.values():
+            for target in targets:
+                commits[target] = oid
+
+    if introduced and not cache_hit:
+        _write_cache(introduced[1], introduced[0], commits)
+    return [BlameLine(commit=commit, line=line) for commit, line in zip(commits, lines)]
+
+def _add_pending(pending, oid, blob, line_map):
+    if oid not in pending:
+        pending[oid] = (blob, line_map)
+        return
+    pending_blob, pending_map = pending[oid]
+    assert pending_blob == blob
+    for line, targets in line_map.items():
+        pending_map.setdefault(line, []).extend(targets)
+
+# Returns the generation number of the given commit: 1 for a root commit, otherwise one more than the highest
+# generation of its parents. generations memoises the results across calls.
+def _get_generation(oid, generations):
+    stack = [oid]
+    while stack:
+        current = stack[-1]
+        if current in generations:
+            stack.pop()
+            continue
+        parents = base.get_commit(current).parents
+        missing = [parent for parent in parents if parent not in generations]
+        if missing:
+            stack.extend(missing)
+            continue
+        generations[current] = 1 + max((generations[parent] for parent in parents), default=0)
+        stack.pop()
+    return generations[oid]
+
+# Returns the blob of the file at path in the given commit, or None if there is no such file.
+def _get_blob_oid(commit_oid, path):
+    type_, oid = base.get_path_entry(base.get_commit(commit_oid).tree, path)
+    return oid if type_ == 'blob' else None
+
+def _get_blob_lines(oid):
+    return data.get_object(oid).partition(b'\x00')[2].splitlines(keepends=True)
+
+# The blame cache holds, per blob, the commit that introduced the blob and the commit of each of its lines. It is
+# only valid for that introducing commit, so later blames of a file reuse it as soon as they reach that version.
+def _get_cache_path(blob):
+    return os.path.join(data.GIT_DIR, 'blame', blob[:2], blob[2:])
+
+def _read_cache(blob, oid):
+    try:
+        with open(_get_cache_path(blob), 'r') as f:
+            introduced, *commits = f.read().splitlines()
+    except (FileNotFoundError, ValueError):
+        return None
+    if introduced != oid:
+        return None
+    return commits
+
+def _write_cache(blob, oid, commits):
+    # The cache is optional, so make a single attempt and skip the write if another process holds the lock.
+    try:
+        with data.LockFile(_get_cache_path(blob), retries=1) as lock:
+            lock.write(''.join(f'{line}\n' for line in [oid, *commits]))
+            lock.commit()
+    except TimeoutError:
+        pass
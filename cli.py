@@ -1,10 +1,15 @@
 import argparse
+import fnmatch
+import itertools
+import os
 import subprocess
 from dotenv import load_dotenv
 import data
 import base
 import textwrap
 import diff
+import remote
+import blame
 import sys
 
 def main():
@@ -69,10 +74,12 @@ def parse_args():
 
     status_parser = commands.add_parser('status')
     status_parser.set_defaults(func=status)
+    status_parser.add_argument('paths', nargs='*', help='Restrict the status to the given pathspecs')
 
     show_parser = commands.add_parser('show')
     show_parser.set_defaults(func=show)
-    show_parser.add_argument('object', type=oid, default='HEAD', nargs='?')
+    show_parser.add_argument('object_and_paths', nargs='*', metavar='[object] path',
+                             help='Commit to show (HEAD by default), optionally followed by pathspecs')
 
     reset_parser = commands.add_parser('reset')
     reset_parser.set_defaults(func=reset)
@@ -80,7 +87,8 @@ def parse_args():
 
     diff_parser = commands.add_parser('diff')
     diff_parser.set_defaults(func=_diff)
-    diff_parser.add_argument('commit', type=oid, default='HEAD', nargs='?')
+    diff_parser.add_argument('commit_and_paths', nargs='*', metavar='[commit] path',
+                             help='Commit to diff against (HEAD by default), optionally followed by pathspecs')
 
     merge_parser = commands.add_parser('merge')
     merge_parser.set_defaults(func=merge)
@@ -94,8 +102,27 @@ def parse_args():
     show_ref_parser = commands.add_parser('show-ref')
     show_ref_parser.set_defaults(func=show_ref)
 
+    blame_parser = commands.add_parser('blame')
+    blame_parser.set_defaults(func=_blame)
+    blame_parser.add_argument('path')
+    blame_parser.add_argument('commit', type=oid, default='HEAD', nargs='?')
+
+    clone_parser = commands.add_parser('clone')
+    clone_parser.set_defaults(func=clone)
+    clone_parser.add_argument('remote', help='Path of the repository to clone')
+    clone_parser.add_argument('directory', nargs='?')
+
+    fetch_parser = commands.add_parser('fetch')
+    fetch_parser.set_defaults(func=fetch)
+    fetch_parser.add_argument('remote', help='Path of the repository to fetch from')
+
     viz_refs_parser = commands.add_parser('viz-refs')
     viz_refs_parser.set_defaults(func=viz_refs)
+    viz_refs_parser.add_argument('refs', nargs='*', help='Only graph refs matching these patterns, e.g. master or refs/tags/*')
+    viz_refs_parser.add_argument('--output', '-o', default='-', help='File to write to, stdout by default')
+    viz_refs_parser.add_argument('--max-commits', type=_non_negative_int, help='Stop after this many commits')
+    viz_refs_parser.add_argument('--simplify', action='store_true', help='Collapse linear chains of commits into one node')
+    viz_refs_parser.add_argument('--png', action='store_true', help='Render with graphviz dot instead of writing DOT')
 
     tester_parser = commands.add_parser('test')
     tester_parser.add_argument('--object')
@@ -103,6 +130,12 @@ def parse_args():
 
     return parser.parse_args()
 
+def _non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f'must not be negative: {value}')
+    return number
+
 def tester(args):
     print(base.get_tree(args.object))
 
@@ -165,10 +198,11 @@ def status(args):
         print(f'Merging HEAD with {MERGE_VALUE[:10]}')
 
     head_tree = base.get_commit(HEAD).tree
-    working_tree = base.get_working_directory()
+    working_tree = base.get_working_directory(args.paths)
 
     changed = {}
-    for path, action in diff.iter_changed_files(base.get_tree(head_tree), working_tree):
+    for path, action in diff.iter_changed_files(base.get_tree(head_tree, pathspecs=args.paths, sparse=True),
+                                                working_tree):
         changed[path] = action
     if changed and len(changed) > 0:
         print("Changes to be committed:")
@@ -200,14 +234,23 @@ def format_ref_str(refs):
 def clean_ref_str(ref_str):
     return ref_str.replace('refs/heads/', '').replace('refs/tags/', '')
 
+# Splits the positional arguments of show and diff into a commit and pathspecs. The first argument is taken as the
+# commit if it names a reference or object; otherwise all arguments are pathspecs and the commit is HEAD.
+def _split_commit_and_paths(values):
+    if values and (values[0] == 'HEAD' or base.find_oid(values[0])):
+        return base.get_oid(values[0]), values[1:]
+    return base.get_oid('HEAD'), values
+
 def show(args):
-    if not args.object:
+    oid, paths = _split_commit_and_paths(args.object_and_paths)
+    if not oid:
         return
-    commit = base.get_commit(args.object)
+    commit = base.get_commit(oid)
     parent_tree = None
     if commit.parents:
         parent_tree = base.get_commit(commit.parents[0]).tree
-    result = diff.diff_trees(base.get_tree(parent_tree), base.get_tree(commit.tree))
+    result = diff.diff_trees(base.get_tree(parent_tree, pathspecs=paths),
+                             base.get_tree(commit.tree, pathspecs=paths))
     sys.stdout.flush()
     sys.stdout.buffer.write(result)
 
@@ -215,9 +258,11 @@ def reset(args):
     base.reset(args.commit)
 
 def _diff(args):
-    tree = args.commit and base.get_commit(args.commit).tree
+    oid, paths = _split_commit_and_paths(args.commit_and_paths)
+    tree = oid and base.get_commit(oid).tree
     sys.stdout.flush()
-    sys.stdout.buffer.write(diff.diff_trees(base.get_tree(tree), base.get_working_directory()))
+    sys.stdout.buffer.write(diff.diff_trees(base.get_tree(tree, pathspecs=paths, sparse=True),
+                                            base.get_working_directory(paths)))
 
 def merge(args):
     base.merge(args.commit)
@@ -228,25 +273,109 @@ def merge_base(args):
 def show_ref(args):
     data.show_ref()
 
+def _blame(args):
+    path = os.path.relpath(args.path)
+    sys.stdout.flush()
+    for number, blame_line in enumerate(blame.blame(path, args.commit), start=1):
+        prefix = f'{data.COLORS["YELLOW"]}{blame_line.commit[:10]}{data.COLORS["RESET"]} {number:>4}) '
+        sys.stdout.buffer.write(prefix.encode() + blame_line.line.rstrip(b'\n') + b'\n')
+    sys.stdout.flush()
+
+def clone(args):
+    remote.clone(args.remote, args.directory)
+
+def fetch(args):
+    remote.fetch(args.remote)
+
+# Writes the commit graph of the selected refs as DOT, line by line, so that memory use does not grow with the
+# size of the output. With --png the lines are piped into graphviz instead.
 def viz_refs(args):
-    dot = 'digraph commits {\n'
-    oids = set()
-    for ref, refname in data.iter_refs():
-         dot += f'"{refname}" [shape=note]\n'
-         dot += f'"{refname}" -> "{ref}"\n'
-         oids.add(ref)
-
-    for oid in base.iter_commits_and_parents(oids):
-        commit = base.get_commit(oid)
-        dot += f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
-        for parent in commit.parents:
-            dot += f'"{oid}" -> "{parent}"\n'
-    dot += '}'
-
-    with subprocess.Popen(
-            ['dot', '-Tpng', '/dev/stdin'],
-            stdin=subprocess.PIPE) as proc:
-        proc.communicate(dot.encode())
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        lines = _iter_viz_dot(args.refs, args.max_commits, args.simplify)
+        if args.png:
+            with subprocess.Popen(['dot', '-Tpng'], stdin=subprocess.PIPE, stdout=out) as proc:
+                proc.stdin.writelines(line.encode() for line in lines)
+                proc.stdin.close()
+        else:
+            out.writelines(line.encode() for line in lines)
+            out.flush()
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+def _iter_viz_dot(patterns, max_commits=None, simplify=False):
+    yield 'digraph commits {\n'
+    refs = {}
+    for refname, ref in data.iter_refs():
+        if not ref.value:
+            continue
+        if patterns and not any(fnmatch.fnmatchcase(name, pattern)
+                                for name in (refname, clean_ref_str(refname)) for pattern in patterns):
+            continue
+        refs.setdefault(ref.value, []).append(refname)
+        yield f'"{refname}" [shape=note]\n'
+        yield f'"{refname}" -> "{ref.value}"\n'
+
+    commits = itertools.islice(base.iter_commits_and_parents(set(refs)), max_commits)
+    if simplify:
+        yield from _iter_simplified_commit_nodes(commits, refs)
+    else:
+        yield from _iter_commit_nodes(commits)
+    yield '}\n'
+
+def _commit_node(oid, label=None):
+    return f'"{oid}" [shape=box style=filled label="{label or oid[:10]}"]\n'
+
+def _iter_commit_nodes(commits):
+    emitted = set()
+    parents = set()
+    for oid in commits:
+        emitted.add(oid)
+        yield _commit_node(oid)
+        for parent in base.get_commit(oid).parents:
+            parents.add(parent)
+            yield f'"{oid}" -> "{parent}"\n'
+    # Parents cut off by --max-commits
+    for parent in parents - emitted:
+        yield f'"{parent}" [shape=plaintext label="..."]\n'
+
+# A commit is kept as its own node if a ref points at it or it is not a plain link in a chain, i.e. it does not have
+# exactly one parent, within the graph, and exactly one child. Commits with a parent cut off by --max-commits are
+# therefore kept, along with their '...' edge. Runs of the remaining commits are collapsed into one node.
+def _iter_simplified_commit_nodes(commits, refs):
+    parents = {oid: base.get_commit(oid).parents for oid in commits}
+    children = {}
+    for oid, commit_parents in parents.items():
+        for parent in commit_parents:
+            children[parent] = children.get(parent, 0) + 1
+
+    def is_kept(oid):
+        return (oid in refs or len(parents[oid]) != 1 or parents[oid][0] not in parents
+                or children.get(oid, 0) != 1)
+
+    for oid in parents:
+        if not is_kept(oid):
+            continue
+        yield _commit_node(oid)
+        for parent in parents[oid]:
+            if parent not in parents:
+                yield f'"{parent}" [shape=plaintext label="..."]\n'
+                yield f'"{oid}" -> "{parent}"\n'
+                continue
+            chain = []
+            while not is_kept(parent):
+                chain.append(parent)
+                parent = parents[parent][0]
+            if chain:
+                label = chain[0][:10]
+                if len(chain) > 1:
+                    label = f'{chain[0][:10]}..{chain[-1][:10]}\\n({len(chain)} commits)'
+                yield _commit_node(chain[0], label)
+                yield f'"{oid}" -> "{chain[0]}"\n'
+                yield f'"{chain[0]}" -> "{parent}"\n'
+            else:
+                yield f'"{oid}" -> "{parent}"\n'
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,11 +1,20 @@
 import os, sys, shutil
 import hashlib
+import random
+import time
 from collections import namedtuple
+from contextlib import contextmanager
 
 GIT_DIR = '.egit'
 OBJ_DIR = os.path.join(GIT_DIR, 'objects')
 REF_DIR = os.path.join(GIT_DIR, 'refs')
 HEAD = os.path.join(GIT_DIR, 'HEAD')
+INDEX = os.path.join(GIT_DIR, 'index')
+SPARSE_CHECKOUT = os.path.join(GIT_DIR, 'sparse-checkout')
+LOCK_SUFFIX = '.lock'
+LOCK_RETRIES = 10
+LOCK_BACKOFF = 0.01
+LOCK_BACKOFF_MAX = 1.0
 OBJ_TYPES = {
     'blob': '100644',
     'tree': '040000'
@@ -18,8 +27,29 @@ COLORS = {
     'BOLD': '\033[1m'
 }
 
+PACK_SIGNATURE = b'EPACK'
+
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
 
+# Sentinel for update_ref: skip the compare step of compare-and-swap.
+ANY_VALUE = object()
+
+# Temporarily points all repository paths at another .egit directory, e.g. the one of a remote repository.
+@contextmanager
+def change_git_dir(git_dir):
+    global GIT_DIR, OBJ_DIR, REF_DIR, HEAD, INDEX, SPARSE_CHECKOUT
+    saved = GIT_DIR, OBJ_DIR, REF_DIR, HEAD, INDEX, SPARSE_CHECKOUT
+    GIT_DIR = git_dir
+    OBJ_DIR = os.path.join(GIT_DIR, 'objects')
+    REF_DIR = os.path.join(GIT_DIR, 'refs')
+    HEAD = os.path.join(GIT_DIR, 'HEAD')
+    INDEX = os.path.join(GIT_DIR, 'index')
+    SPARSE_CHECKOUT = os.path.join(GIT_DIR, 'sparse-checkout')
+    try:
+        yield
+    finally:
+        GIT_DIR, OBJ_DIR, REF_DIR, HEAD, INDEX, SPARSE_CHECKOUT = saved
+
 def init():
     exists = False
     if os.path.isdir(GIT_DIR):
@@ -44,17 +74,78 @@ def hash_object(filetype, data, write=False):
     header = create_object_header(filetype, data)
     object_id = hashlib.sha1(header + data).hexdigest()
     if write:
-        os.makedirs(os.path.join(OBJ_DIR, object_id[:2]), exist_ok=True)
-        with open(os.path.join(OBJ_DIR, object_id[:2], object_id[2:]), "wb") as out:
-            out.write(header + data)
+        _write_object(object_id, header + data)
     return object_id
 
+# Writes an object to a temporary file and renames it into place, so readers never see a partially written object.
+# Objects are content addressed, so concurrent writers of the same object race harmlessly and need no lock.
+def _write_object(object_id, content):
+    object_dir = os.path.join(OBJ_DIR, object_id[:2])
+    object_path = os.path.join(object_dir, object_id[2:])
+    if os.path.isfile(object_path):
+        return
+    os.makedirs(object_dir, exist_ok=True)
+    # Created with 0666 so the umask applies as for any other file, keeping objects readable in shared repositories.
+    tmp_path = os.path.join(object_dir, f'tmp_obj_{os.urandom(8).hex()}')
+    fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(content)
+        os.replace(tmp_path, object_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
 ### ALL OBJECT ACCESSORS RETURN BYTE ARRAYS ###
 
+def get_object_path(oid):
+    return os.path.join(OBJ_DIR, oid[:2], oid[2:])
+
+def object_exists(oid):
+    return os.path.isfile(get_object_path(oid))
+
 def get_object(oid):
-    with open(os.path.join(OBJ_DIR, oid[:2], oid[2:]), 'rb') as infile:
+    with open(get_object_path(oid), 'rb') as infile:
         return infile.read()
 
+# Hard-links the object file of the given object ID from another objects directory into this repository.
+# Objects are immutable once written, so sharing the inode is safe. Raises OSError if linking is not possible,
+# e.g. across filesystems.
+def link_object(oid, source_obj_dir):
+    object_path = get_object_path(oid)
+    if os.path.isfile(object_path):
+        return
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    try:
+        os.link(os.path.join(source_obj_dir, oid[:2], oid[2:]), object_path)
+    except FileExistsError:
+        pass
+
+# Streams the given objects into a single pack: a signature and object count line followed by the raw objects
+# back to back. Each raw object starts with its '<type> <size>\0' header, which delimits it within the pack.
+def write_pack(oids, out):
+    oids = list(oids)
+    out.write(PACK_SIGNATURE + f' {len(oids)}\n'.encode())
+    for oid in oids:
+        out.write(get_object(oid))
+
+# Reads a pack written by write_pack and writes each object into this repository. Returns the list of object IDs.
+def read_pack(pack):
+    signature, _, count = pack.readline().strip().partition(b' ')
+    assert signature == PACK_SIGNATURE, 'Not an egit pack'
+    oids = []
+    for _ in range(int(count)):
+        header = b''
+        while not header.endswith(b'\x00'):
+            byte = pack.read(1)
+            assert byte, 'Truncated pack'
+            header += byte
+        type_, _, size = header[:-1].partition(b' ')
+        content = pack.read(int(size))
+        assert len(content) == int(size), 'Truncated pack'
+        oids.append(hash_object(type_.decode(), content, write=True))
+    return oids
+
 def create_object_header(filetype, data):
     """
     In the future will determine the appropriate header for a given object that is to be hashed.
@@ -68,7 +159,6 @@ def _get_object_parts(data):
     header_bytes, _, content = data.partition(b'\x00')
     type_, _, size = header_bytes.partition(b'\x20')
     header = [type_, size]
-    content = data[len(header_bytes):]
     return header, content
 
 def _extract_object_header(data):
@@ -115,14 +205,78 @@ def get_ignore_list():
 
     return ignored_data.decode().splitlines()
 
+# Returns the list of pathspecs recorded in the sparse-checkout file. An empty list means a full checkout.
+def get_sparse_patterns():
+    try:
+        with open(SPARSE_CHECKOUT, 'rb') as f:
+            sparse_data = f.read()
+    except FileNotFoundError:
+        return []
+
+    return [line.strip() for line in sparse_data.decode().splitlines() if line.strip() and not line.startswith('#')]
+
 def rmobj(oid):
     shutil.rmtree(os.path.join(OBJ_DIR, oid[:2]))
     sys.stdout.flush()
     sys.stdout.buffer.write(f"Removed object: {oid}\n".encode())
 
+# Sleeps before retry number attempt, with bounded exponential backoff and jitter so that competing processes
+# spread out instead of retrying in lockstep.
+def backoff(attempt):
+    delay = min(LOCK_BACKOFF * 2 ** attempt, LOCK_BACKOFF_MAX)
+    time.sleep(delay * random.uniform(0.5, 1.5))
+
+# Holds <path>.lock for the duration of a with block. Content written to the lock is only published to <path> by
+# commit(), which renames the lock over the target; otherwise the lock is simply released on exit.
+# retries=1 makes a single non-blocking attempt.
+class LockFile:
+    def __init__(self, path, retries=LOCK_RETRIES):
+        self.path = path
+        self.lock_path = f'{path}{LOCK_SUFFIX}'
+        self.retries = retries
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        for attempt in range(self.retries):
+            if attempt:
+                backoff(attempt - 1)
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+                self._file = os.fdopen(fd, 'w')
+                return self
+            except FileExistsError:
+                pass
+        raise TimeoutError(f'Unable to lock {self.path}: {self.lock_path} exists. '
+                           f'If no other egit process is running, remove it and try again.')
+
+    def write(self, content):
+        self._file.write(content)
+
+    def commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        os.replace(self.lock_path, self.path)
+
+    def __exit__(self, *exc_info):
+        # Only remove the lock if we still own it; after commit() the lock path may belong to another process.
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.lock_path)
+        return False
+
+# Repository-wide lock guarding working directory, index and merge state (MERGE_HEAD).
+# Always acquire it before any ref lock to keep the lock order consistent.
+def repository_lock():
+    return LockFile(INDEX)
+
 # Changes the object ID of the provided reference to the provided value. If the reference does not exist,
-# it creates one.
-def update_ref(ref, oid, deref=True):
+# it creates one. The update is a compare-and-swap under <ref>.lock: if expected is given and the reference no
+# longer holds that value (None meaning it must not exist), nothing is written and False is returned.
+def update_ref(ref, oid, deref=True, expected=ANY_VALUE):
     ref = _get_ref_internal(ref, deref)[0]
     assert oid.value
     if oid.symbolic:
@@ -130,17 +284,25 @@ def update_ref(ref, oid, deref=True):
     else:
         value = oid.value
     ref_path = os.path.join(GIT_DIR, ref)
-    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
-    with open(ref_path, 'w') as f:
-        f.write(f'{value}\n')
+    with LockFile(ref_path) as lock:
+        if expected is not ANY_VALUE and _get_ref_internal(ref, deref=False)[1].value != expected:
+            return False
+        lock.write(f'{value}\n')
+        lock.commit()
+    return True
 
 # Returns the object ID associated with the provided reference (if it exists, else None).
 def get_ref(ref, deref=True):
     return _get_ref_internal(ref, deref)[1]
 
-def delete_ref(ref, deref=True):
+def delete_ref(ref, deref=True, expected=ANY_VALUE):
     ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f'{GIT_DIR}/{ref}')
+    ref_path = os.path.join(GIT_DIR, ref)
+    with LockFile(ref_path):
+        if expected is not ANY_VALUE and _get_ref_internal(ref, deref=False)[1].value != expected:
+            return False
+        os.remove(ref_path)
+    return True
 
 def _get_ref_internal(ref, deref):
     ref_path = os.path.join(GIT_DIR, ref)
@@ -170,7 +332,7 @@ def iter_refs(prefix='', deref=True):
         refs.append('MERGE_HEAD')
     for root, _, filenames in os.walk(os.path.join(REF_DIR)):
         root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f'{root}/{filename}' for filename in filenames)
+        refs.extend(f'{root}/{filename}' for filename in filenames if not filename.endswith(LOCK_SUFFIX))
 
     for ref in refs:
         if not ref.startswith(prefix):
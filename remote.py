@@ -0,0 +1,129 @@
+import os
+import tempfile
+import data
+import base
+
+REMOTE_REFS_BASE = 'refs/heads/'
+LOCAL_REFS_BASE = 'refs/remote/'
+TAGS_BASE = 'refs/tags/'
+
+# Copies the history of the repository at remote_path into a new repository in directory and checks out the
+# branch the remote HEAD points at.
+def clone(remote_path, directory=None):
+    remote_path = os.path.abspath(remote_path)
+    directory = directory or os.path.basename(remote_path.rstrip('/'))
+    # Checking out empties the working directory, so never clone into a directory that already holds files.
+    assert not os.path.exists(directory) or not os.listdir(directory), \
+        f'Destination path {directory} already exists and is not an empty directory'
+    with data.change_git_dir(_get_remote_git_dir(remote_path)):
+        branch = base.get_branch_name()
+        HEAD = data.get_ref('HEAD').value
+
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    base.reload_ignore_list()
+    data.init()
+    # A detached remote HEAD may point at a commit no branch or tag reaches, so fetch it explicitly.
+    fetch(remote_path, wants={HEAD} if HEAD else ())
+    if not HEAD:
+        return
+
+    if branch:
+        data.update_ref(f'refs/heads/{branch}', data.RefValue(symbolic=False, value=HEAD))
+        base.checkout(branch)
+    else:
+        base.checkout(HEAD)
+    # The checkout brought in the repository's own .egitignore
+    base.reload_ignore_list()
+
+# Fetches the branches and tags of the repository at remote_path. Branches are stored under refs/remote/, tags
+# that do not exist locally are created. Only objects missing from this repository are transferred. wants are
+# additional remote commits to fetch along with the ref tips.
+def fetch(remote_path, wants=()):
+    remote_git_dir = _get_remote_git_dir(remote_path)
+    with data.change_git_dir(remote_git_dir):
+        remote_refs = {refname: ref.value for refname, ref in data.iter_refs()
+                       if ref.value and refname.startswith((REMOTE_REFS_BASE, TAGS_BASE))}
+
+    oids = _find_missing_objects(remote_git_dir, set(remote_refs.values()) | set(wants))
+    count = _transfer_objects(remote_git_dir, oids)
+    print(f'Fetched {count} objects from {remote_path}')
+
+    for refname, value in remote_refs.items():
+        if refname.startswith(TAGS_BASE):
+            if data.update_ref(refname, data.RefValue(symbolic=False, value=value), expected=None):
+                print(f' * [new tag] {os.path.relpath(refname, TAGS_BASE)}')
+            continue
+        local_refname = f'{LOCAL_REFS_BASE}{os.path.relpath(refname, REMOTE_REFS_BASE)}'
+        old_value = data.get_ref(local_refname).value
+        if old_value != value:
+            data.update_ref(local_refname, data.RefValue(symbolic=False, value=value))
+            print(f' {(old_value or "(new)")[:10]}..{value[:10]} {local_refname}')
+
+def _get_remote_git_dir(remote_path):
+    remote_git_dir = os.path.join(os.path.abspath(remote_path), data.GIT_DIR)
+    assert os.path.isdir(remote_git_dir), f'Not an egit repository: {remote_path}'
+    return remote_git_dir
+
+# Have/want negotiation. The wants are the remote ref tips, the haves are the commits reachable from our own
+# refs. The remote history is walked from the wants and the walk stops at any commit we have, so only the
+# commits that are new to us are visited. Returns the missing object IDs, each tree after its entries and each
+# commit after its tree.
+def _find_missing_objects(remote_git_dir, wants):
+    local_tips = {ref.value for _, ref in data.iter_refs() if ref.value}
+    haves = set(base.iter_commits_and_parents(local_tips))
+    local_git_dir = data.GIT_DIR
+
+    missing = []
+    seen = set()
+    with data.change_git_dir(remote_git_dir):
+        for oid in base.iter_commits_and_parents(wants - haves, exclude=haves):
+            commit = base.get_commit(oid)
+            _find_missing_tree_objects(commit.tree, local_git_dir, missing, seen)
+            with data.change_git_dir(local_git_dir):
+                if not data.object_exists(oid):
+                    missing.append(oid)
+    return missing
+
+# Appends the objects of the given remote tree that do not exist locally. Trees are written after their entries,
+# so an existing local tree is complete and is not descended into.
+def _find_missing_tree_objects(tree_id, local_git_dir, missing, seen):
+    if tree_id in seen:
+        return
+    seen.add(tree_id)
+    with data.change_git_dir(local_git_dir):
+        if data.object_exists(tree_id):
+            return
+    for type_, oid, _ in base._iterate_tree(tree_id):
+        if type_ == 'tree':
+            _find_missing_tree_objects(oid, local_git_dir, missing, seen)
+        elif oid not in seen:
+            seen.add(oid)
+            with data.change_git_dir(local_git_dir):
+                if data.object_exists(oid):
+                    continue
+            missing.append(oid)
+    missing.append(tree_id)
+
+# Copies the given objects from the remote repository. On the same filesystem the loose objects are hard-linked;
+# anything that cannot be linked is streamed into a single pack and unpacked here. Returns the number of objects.
+def _transfer_objects(remote_git_dir, oids):
+    remote_obj_dir = os.path.join(remote_git_dir, 'objects')
+    unlinked = []
+    if os.stat(remote_obj_dir).st_dev == os.stat(data.OBJ_DIR).st_dev:
+        for oid in oids:
+            try:
+                data.link_object(oid, remote_obj_dir)
+            except OSError:
+                unlinked.append(oid)
+    else:
+        unlinked = oids
+
+    if unlinked:
+        with tempfile.TemporaryFile(dir=data.GIT_DIR) as pack:
+            with data.change_git_dir(remote_git_dir):
+                data.write_pack(unlinked, pack)
+            pack.seek(0)
+            received = data.read_pack(pack)
+        assert received == unlinked, 'Pack is corrupt'
+    return len(oids)
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+from collections import Counter
+from unittest import mock
+import data
+import base
+import blame
+
+# Runs blame in a throwaway repository. All egit paths are relative to the working directory, so the test changes
+# into the repository.
+class BlameTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        data.init()
+        os.makedirs('d')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    # Writes d/f.txt and, if given, another file, then commits
+    def _commit(self, message, content=None, other=None):
+        if content is not None:
+            self._write('d/f.txt', content)
+        if other is not None:
+            self._write('other', other)
+        return base.commit(message).split()[-1]
+
+    def _blame(self, commit='HEAD'):
+        return [(result.commit, result.line) for result in blame.blame('d/f.txt', base.get_oid(commit))]
+
+    def test_linear_history(self):
+        c1 = self._commit('c1', 'one\ntwo\nthree\n')
+        self._commit('c2', other='x\n')
+        c3 = self._commit('c3', 'zero\none\nTWO\nthree\n')
+        self.assertEqual(self._blame(), [(c3, b'zero\n'), (c1, b'one\n'), (c3, b'TWO\n'), (c1, b'three\n')])
+
+    def test_merge_where_both_sides_changed_the_file(self):
+        c1 = self._commit('c1', 'one\ntwo\nthree\n')
+        c2 = self._commit('c2', other='x\n')
+        c3 = self._commit('c3', 'zero\none\nTWO\nthree\n')
+        base.checkout(c2)
+        data.new_branch('side')
+        base.checkout('side')
+        c4 = self._commit('c4', 'one\ntwo\nthree\nfour\n')
+        base.checkout('master')
+        base.merge(c4)
+        merge = self._commit('merge', 'zero\none\nTWO\nthree\nfour\n')
+
+        self.assertEqual(base.get_commit(merge).parents, [c3, c4])
+        self.assertEqual(self._blame(), [
+            (c3, b'zero\n'), (c1, b'one\n'), (c3, b'TWO\n'), (c1, b'three\n'), (c4, b'four\n')])
+
+    def test_each_commit_is_processed_once(self):
+        c1 = self._commit('c1', 'a\nb\nc\n')
+        x = self._commit('x', 'a\nB\nc\n')
+        data.new_branch('side')
+        self._commit('x2', 'a\nB\n')
+        base.checkout('side')
+        y = self._commit('y', 'a\nB\nc\nd\n')
+        base.checkout('master')
+        base.merge(y)
+        merge = self._commit('merge', 'a\nB\nc\nd\ne\n')
+
+        # Lines reach x both through x2 and through y
+        with mock.patch.object(blame, '_read_cache', wraps=blame._read_cache) as read_cache:
+            result = self._blame()
+        self.assertEqual(result, [(c1, b'a\n'), (x, b'B\n'), (c1, b'c\n'), (y, b'd\n'), (merge, b'e\n')])
+        processed = Counter(call.args[1] for call in read_cache.call_args_list)
+        self.assertEqual(max(processed.values()), 1)
+
+    def test_second_blame_hits_the_cache(self):
+        c1 = self._commit('c1', 'one\ntwo\n')
+        c2 = self._commit('c2', 'one\nTWO\n')
+        self._blame()
+
+        c3 = self._commit('c3', 'one\nTWO\nthree\n')
+        with mock.patch.object(blame.difflib, 'SequenceMatcher', wraps=blame.difflib.SequenceMatcher) as matcher, \
+                mock.patch.object(blame, '_write_cache', wraps=blame._write_cache) as write_cache:
+            result = self._blame()
+        self.assertEqual(result, [(c1, b'one\n'), (c2, b'TWO\n'), (c3, b'three\n')])
+        # Only c3 is diffed; everything before comes from the cache entry written by the first blame
+        self.assertEqual(matcher.call_count, 1)
+        self.assertEqual(write_cache.call_args.args[1], c3)
+
+        with mock.patch.object(blame, '_write_cache') as write_cache:
+            self.assertEqual(self._blame(), result)
+        write_cache.assert_not_called()
+
+    def test_cache_for_another_commit_is_not_used(self):
+        c1 = self._commit('c1', 'one\n')
+        blob = base.get_path_entry(base.get_commit(c1).tree, 'd/f.txt')[1]
+        blame._write_cache(blob, 'f' * 40, ['f' * 40])
+        self.assertEqual(self._blame(), [(c1, b'one\n')])
+
+    def test_cache_write_does_not_wait_for_lock(self):
+        c1 = self._commit('c1', 'one\n')
+        blob = base.get_path_entry(base.get_commit(c1).tree, 'd/f.txt')[1]
+        with data.LockFile(blame._get_cache_path(blob)), mock.patch.object(data, 'backoff') as backoff:
+            self.assertEqual(self._blame(), [(c1, b'one\n')])
+        backoff.assert_not_called()
+        self.assertFalse(os.path.exists(blame._get_cache_path(blob)))
+
+    def test_rejects_directories_and_missing_files(self):
+        c1 = self._commit('c1', 'one\n')
+        for path in ('.', 'd', 'd/missing.txt'):
+            with self.assertRaises(AssertionError):
+                blame.blame(path, c1)
+
+if __name__ == '__main__':
+    unittest.main()
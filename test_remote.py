@@ -0,0 +1,136 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import data
+import base
+import remote
+
+# Runs clone and fetch between two throwaway repositories. All egit paths are relative to the working directory,
+# so each step changes into the repository it acts on.
+class RemoteTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'source')
+        self.target = os.path.join(self.tmp.name, 'target')
+        os.makedirs(os.path.join(self.source, 'sub'))
+        os.chdir(self.source)
+        data.init()
+        self._write('a.txt', 'a\n')
+        self._write('sub/b.txt', 'b\n')
+        self.first = self._commit('first')
+        base.tag('v1', self.first)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        base.reload_ignore_list()
+        self.tmp.cleanup()
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _commit(self, message):
+        return base.commit(message).split()[-1]
+
+    def _clone(self):
+        os.chdir(self.tmp.name)
+        remote.clone(self.source, self.target)
+        os.chdir(self.target)
+
+    def _count_objects(self):
+        return sum(len(filenames) for _, _, filenames in os.walk(data.OBJ_DIR))
+
+    def test_clone(self):
+        self._clone()
+        self.assertEqual(base.get_branch_name(), 'master')
+        self.assertEqual(base.get_oid('HEAD'), self.first)
+        self.assertEqual(base.get_oid('remote/master'), self.first)
+        self.assertEqual(list(base.iter_commits_and_parents({'HEAD'})), [self.first])
+        with open('sub/b.txt', 'rb') as f:
+            self.assertIn(b'b\n', f.read())
+
+    def test_clone_detached_head(self):
+        base.checkout(self.first)
+        self._write('a.txt', 'detached\n')
+        detached = self._commit('detached')
+
+        self._clone()
+        self.assertIsNone(base.get_branch_name())
+        self.assertEqual(base.get_oid('HEAD'), detached)
+        self.assertEqual(base.get_oid('remote/master'), self.first)
+        with open('a.txt', 'rb') as f:
+            self.assertIn(b'detached\n', f.read())
+
+    def test_clone_reads_ignore_list_of_new_repository(self):
+        self._write('.egitignore', 'build\n')
+        self._commit('ignore build')
+        os.chdir(self.tmp.name)
+        base.reload_ignore_list()
+
+        self._clone()
+        self.assertEqual(base.ignore_list, ['build'])
+        self.assertTrue(base.is_ignored('./build/out.o'))
+
+    def test_clone_refuses_non_empty_directory(self):
+        os.makedirs(self.target)
+        self._write(os.path.join(self.target, 'mine.txt'), 'mine\n')
+        os.chdir(self.tmp.name)
+        with self.assertRaises(AssertionError):
+            remote.clone(self.source, self.target)
+        self.assertEqual(os.listdir(self.target), ['mine.txt'])
+
+    def test_fetch_transfers_only_new_objects(self):
+        self._clone()
+        os.chdir(self.source)
+        self._write('sub/b.txt', 'b2\n')
+        second = self._commit('second')
+
+        os.chdir(self.target)
+        with mock.patch.object(remote, '_transfer_objects', wraps=remote._transfer_objects) as transfer:
+            remote.fetch(self.source)
+        # The new commit, the root tree, the changed subtree and the changed blob
+        self.assertEqual(len(transfer.call_args.args[1]), 4)
+        self.assertEqual(base.get_oid('remote/master'), second)
+        self.assertEqual(base.get_oid('HEAD'), self.first)
+
+        with mock.patch.object(remote, '_transfer_objects', wraps=remote._transfer_objects) as transfer:
+            remote.fetch(self.source)
+        self.assertEqual(transfer.call_args.args[1], [])
+
+    def test_fetch_hard_links_objects(self):
+        self._clone()
+        self.assertGreater(os.stat(data.get_object_path(self.first)).st_nlink, 1)
+
+    def test_fetch_falls_back_to_pack(self):
+        os.makedirs(self.target)
+        os.chdir(self.target)
+        data.init()
+        with mock.patch.object(data, 'link_object', side_effect=OSError('Invalid cross-device link')):
+            remote.fetch(self.source)
+        self.assertEqual(os.stat(data.get_object_path(self.first)).st_nlink, 1)
+        self.assertEqual(list(base.iter_commits_and_parents({'remote/master'})), [self.first])
+        with data.change_git_dir(os.path.join(self.source, data.GIT_DIR)):
+            source_tree = base.get_tree(base.get_commit(self.first).tree)
+        self.assertEqual(base.get_tree(base.get_commit(self.first).tree), source_tree)
+        self.assertEqual(self._count_objects(), len(source_tree) + 3)
+
+    def test_fetch_tags(self):
+        self._clone()
+        self.assertEqual(base.get_oid('v1'), self.first)
+
+        os.chdir(self.source)
+        self._write('a.txt', 'a2\n')
+        second = self._commit('second')
+        base.tag('v2', second)
+        data.update_ref('refs/tags/v1', data.RefValue(symbolic=False, value=second))
+
+        os.chdir(self.target)
+        remote.fetch(self.source)
+        self.assertEqual(base.get_oid('v2'), second)
+        # Existing local tags are never moved
+        self.assertEqual(base.get_oid('v1'), self.first)
+
+if __name__ == '__main__':
+    unittest.main()
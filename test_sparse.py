@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import data
+import base
+
+try:
+    import cli
+except ModuleNotFoundError:
+    # cli needs python-dotenv
+    cli = None
+
+# Runs sparse checkouts and pathspec-restricted tree operations in a throwaway repository. All egit paths are
+# relative to the working directory, so the test changes into the repository.
+class SparseTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        data.init()
+        for path in ('top.txt', 'src/a.txt', 'src/x/b.txt', 'docs/d.md', 'docs/e.txt', 'lib/keep.py', 'lib/drop.py'):
+            self._write(path, f'{path}\n')
+        self.first = self._commit('first')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _commit(self, message):
+        return base.commit(message).split()[-1]
+
+    def _sparse_checkout(self, *patterns):
+        self._write(data.SPARSE_CHECKOUT, ''.join(f'{pattern}\n' for pattern in patterns))
+        base.checkout('master')
+
+    def _files_on_disk(self):
+        return sorted(base.get_working_directory())
+
+    def _head_tree(self):
+        return base.get_tree(base.get_commit('HEAD').tree)
+
+    def test_is_in_pathspec(self):
+        self.assertTrue(base.is_in_pathspec('src/x/b.txt', ['src']))
+        self.assertTrue(base.is_in_pathspec('src/x/b.txt', ['./src/']))
+        self.assertTrue(base.is_in_pathspec('docs/d.md', ['docs/*.md']))
+        self.assertFalse(base.is_in_pathspec('docs/e.txt', ['docs/*.md']))
+        self.assertFalse(base.is_in_pathspec('srcs/a.txt', ['src']))
+        self.assertTrue(base.is_in_pathspec('anything', []))
+
+    def test_get_tree_with_pathspecs(self):
+        tree = base.get_commit(self.first).tree
+        self.assertEqual(sorted(base.get_tree(tree, pathspecs=['src'])), ['src/a.txt', 'src/x/b.txt'])
+        self.assertEqual(sorted(base.get_tree(tree, pathspecs=['*/*.md', 'top.txt'])), ['docs/d.md', 'top.txt'])
+
+    def test_iter_tree_only_reads_selected_subtrees(self):
+        tree = base.get_commit(self.first).tree
+        docs_tree = base.get_path_entry(tree, 'docs')[1]
+        with mock.patch.object(base, '_iterate_tree', wraps=base._iterate_tree) as iterate_tree:
+            self.assertEqual(list(dict(base.iter_tree(tree, filters=[['src/x']]))), ['src/x/b.txt'])
+        self.assertNotIn(mock.call(docs_tree), iterate_tree.call_args_list)
+
+    def test_sparse_checkout_materialises_selected_paths(self):
+        self._sparse_checkout('src')
+        self.assertEqual(self._files_on_disk(), ['src/a.txt', 'src/x/b.txt'])
+        self.assertFalse(os.path.exists('docs'))
+
+    def test_sparse_commit_keeps_paths_outside_the_checkout(self):
+        before = self._head_tree()
+        self._sparse_checkout('src')
+        self._write('src/a.txt', 'changed\n')
+        self._commit('second')
+
+        after = self._head_tree()
+        self.assertEqual(sorted(after), sorted(before))
+        self.assertNotEqual(after['src/a.txt'], before['src/a.txt'])
+        for path in ('top.txt', 'docs/d.md', 'docs/e.txt', 'lib/keep.py', 'lib/drop.py'):
+            self.assertEqual(after[path], before[path])
+
+    def test_sparse_commit_with_partially_selected_directory_missing_on_disk(self):
+        before = self._head_tree()
+        self._sparse_checkout('src', 'lib/drop.py')
+        self.assertEqual(self._files_on_disk(), ['lib/drop.py', 'src/a.txt', 'src/x/b.txt'])
+        shutil.rmtree('lib')
+        self._commit('drop')
+
+        after = self._head_tree()
+        self.assertNotIn('lib/drop.py', after)
+        self.assertEqual(after['lib/keep.py'], before['lib/keep.py'])
+        self.assertEqual(after['docs/d.md'], before['docs/d.md'])
+
+    def test_status_and_diff_ignore_paths_outside_the_checkout(self):
+        self._sparse_checkout('src')
+        head_tree = base.get_tree(base.get_commit('HEAD').tree, sparse=True)
+        self.assertEqual(sorted(head_tree), ['src/a.txt', 'src/x/b.txt'])
+        self.assertEqual(sorted(base.get_working_directory(['src/x'])), ['src/x/b.txt'])
+
+    @unittest.skipIf(cli is None, 'cli needs python-dotenv')
+    def test_split_commit_and_paths(self):
+        head = base.get_oid('HEAD')
+        self.assertEqual(cli._split_commit_and_paths([]), (head, []))
+        self.assertEqual(cli._split_commit_and_paths(['src']), (head, ['src']))
+        self.assertEqual(cli._split_commit_and_paths(['src', 'docs']), (head, ['src', 'docs']))
+        self.assertEqual(cli._split_commit_and_paths(['HEAD', 'src']), (head, ['src']))
+        self.assertEqual(cli._split_commit_and_paths(['master', 'src']), (head, ['src']))
+        self.assertEqual(cli._split_commit_and_paths([self.first]), (self.first, []))
+
+if __name__ == '__main__':
+    unittest.main()